@@ -8,40 +8,208 @@ Environment Variables Required:
 - FILTERED_IPS: Comma-separated IPs to exclude
 - DATABASE: Athena database name (default: cloudfront_logs_db)
 - TABLE: Athena table name (default: cloudfront_logs)
+- PARTITIONED_BY_DATE: 'true' if TABLE has zero-padded year/month/day
+  string partitions matching date; only valid together with DAILY_TABLE,
+  whose raw-log reads it prunes (default: false)
+- DAILY_TABLE: Optional pre-aggregated Iceberg table partitioned by date;
+  when set, complete days are rolled into it and the report reads them from
+  it, taking only the most recent days from TABLE. Requires
+  PARTITIONED_BY_DATE=true, since otherwise every date-scoped read of TABLE
+  is a full scan. The role also needs glue:GetTable/UpdateTable on the
+  table and s3:GetObject/PutObject/ListBucket on its location to write it
 """
 
 import boto3
+import csv
+import io
 import json
 import os
-from datetime import datetime, timedelta
+from botocore.config import Config
+from datetime import datetime, timedelta, timezone
 import time
 
-athena_client = boto3.client('athena')
+# Athena has no built-in waiters, so let the SDK retry throttled polls for us
+athena_client = boto3.client('athena', config=Config(retries={'mode': 'standard'}))
 sns_client = boto3.client('sns')
+s3_client = boto3.client('s3')
 
 DATABASE = os.environ.get('DATABASE', 'cloudfront_logs_db')
 TABLE = os.environ.get('TABLE', 'cloudfront_logs')
 OUTPUT_LOCATION = os.environ['ATHENA_OUTPUT_LOCATION']
 SNS_TOPIC_ARN = os.environ['SNS_TOPIC_ARN']
-FILTERED_IPS = os.environ['FILTERED_IPS'].split(',')
+FILTERED_IPS = tuple(ip.strip() for ip in os.environ['FILTERED_IPS'].split(','))
+IP_PARAMETERS = tuple(f"'{ip}'" for ip in FILTERED_IPS)
+IP_PLACEHOLDERS = "(" + ", ".join("?" for _ in FILTERED_IPS) + ")"
+PARTITIONED_BY_DATE = os.environ.get('PARTITIONED_BY_DATE', 'false').lower() == 'true'
+DAILY_TABLE = os.environ.get('DAILY_TABLE')
+
+# The daily table already holds per-day visit counts, so the report sums
+# them rather than counting raw log rows. It only covers complete days (see
+# DAILY_ROLLUP_QUERY); anything newer still comes from the raw logs.
+if DAILY_TABLE:
+    # Every raw-log read in this mode is date-scoped; without partitions to
+    # prune, each would scan the whole log table and cost more than the
+    # default single scan
+    if not PARTITIONED_BY_DATE:
+        raise ValueError("DAILY_TABLE requires PARTITIONED_BY_DATE=true")
+    
+    BASE_SOURCE = f"""
+        SELECT date, c_ip, cs_uri_stem, x_edge_location, visits FROM {DAILY_TABLE}
+        WHERE date <= CAST(? AS date)
+        UNION ALL
+        SELECT 
+            date,
+            COALESCE(c_ip, '') AS c_ip,
+            COALESCE(cs_uri_stem, '') AS cs_uri_stem,
+            COALESCE(x_edge_location, '') AS x_edge_location,
+            1 AS visits
+        FROM {TABLE}
+        WHERE ((year = ? AND month = ? AND day = ?) OR (year = ? AND month = ? AND day = ?))
+            AND date > CAST(? AS date)
+    """
+    
+    # Upserts one day's visit counts per visitor, page and edge location into
+    # DAILY_TABLE. CloudFront delivers access logs up to 24 hours late, so a
+    # day is only rolled up once it is two days old; yesterday and today are
+    # always read from the raw logs. DAILY_TABLE must be an Iceberg table:
+    # each MERGE commits atomically, so a failed or abandoned run leaves no
+    # partial day behind, and because matched rows are overwritten rather
+    # than added, rerunning a day (e.g. an async retry racing a still-running
+    # MERGE) can't double-count it. Keys are COALESCEd so NULLs still match.
+    # Backfill the table once with a CTAS over the existing logs, stopping two
+    # days back for the same reason (Athena writes at most 100 partitions per
+    # statement, so split longer histories):
+    #   CREATE TABLE analytics_daily
+    #   WITH (table_type = 'ICEBERG', is_external = false, format = 'PARQUET',
+    #         location = 's3://<bucket>/analytics_daily/',
+    #         partitioning = ARRAY['date']) AS
+    #   SELECT COALESCE(c_ip, '') AS c_ip, COALESCE(cs_uri_stem, '') AS cs_uri_stem,
+    #       COALESCE(x_edge_location, '') AS x_edge_location, COUNT(*) AS visits, date
+    #   FROM cloudfront_logs
+    #   WHERE date <= current_date - INTERVAL '2' DAY
+    #   GROUP BY 1, 2, 3, 5
+    DAILY_ROLLUP_QUERY = f"""
+        MERGE INTO {DAILY_TABLE} t
+        USING (
+            SELECT 
+                COALESCE(c_ip, '') AS c_ip,
+                COALESCE(cs_uri_stem, '') AS cs_uri_stem,
+                COALESCE(x_edge_location, '') AS x_edge_location,
+                COUNT(*) AS visits,
+                date
+            FROM {TABLE}
+            WHERE year = ? AND month = ? AND day = ? AND date = CAST(? AS date)
+            GROUP BY 1, 2, 3, 5
+        ) s
+        ON t.date = CAST(? AS date)
+            AND t.date = s.date
+            AND t.c_ip = s.c_ip
+            AND t.cs_uri_stem = s.cs_uri_stem
+            AND t.x_edge_location = s.x_edge_location
+        WHEN MATCHED THEN UPDATE SET visits = s.visits
+        WHEN NOT MATCHED THEN INSERT (c_ip, cs_uri_stem, x_edge_location, visits, date)
+            VALUES (s.c_ip, s.cs_uri_stem, s.x_edge_location, s.visits, s.date)
+    """
 
+    LAST_ROLLED_UP_DAY_QUERY = f"SELECT MAX(date) FROM {DAILY_TABLE}"
+else:
+    # The default report reads TABLE once in full, so there is nothing to prune
+    if PARTITIONED_BY_DATE:
+        raise ValueError("PARTITIONED_BY_DATE only applies with DAILY_TABLE set")
+    
+    BASE_SOURCE = f"SELECT date, c_ip, cs_uri_stem, x_edge_location, 1 AS visits FROM {TABLE}"
+
+QUERY_TIMEOUT_SECONDS = 60
+ROLLUP_TIMEOUT_SECONDS = 300
+POLL_INITIAL_DELAY = 0.1
+POLL_MAX_DELAY = 2.0
+RESULT_REUSE_MAX_AGE_MINUTES = 1440
+
+_ONE_DAY = timedelta(days=1)
+
+SEPARATOR = "=" * 50
+SECTION_BREAK = "\n" + SEPARATOR
+
+
+class AthenaQueryError(Exception):
+    """Raised when an Athena query fails, is cancelled, or times out."""
+
+
+# Single query computing every report section from one read of the source.
+# One aggregation over GROUPING SETS yields the per-page, per-edge and
+# per-visitor totals plus a grand-total row carrying the overview and
+# yesterday figures; row_number() then keeps the top N of each set. base and
+# flagged are each referenced once, so Athena inlines them without rescanning.
+# Output columns: section, label, value1..value5. Filtered IPs and yesterday's
+# date are bound as execution parameters, so the text is built once per
+# container.
+COMBINED_QUERY = f"""
+    WITH base AS (
+        SELECT * FROM ({BASE_SOURCE})
+        WHERE c_ip NOT IN {IP_PLACEHOLDERS}
+    ),
+    flagged AS (
+        SELECT *, date = CAST(? AS date) as is_yesterday
+        FROM base
+    ),
+    grouped AS (
+        SELECT 
+            GROUPING(cs_uri_stem, x_edge_location, c_ip) as grouping_set,
+            COALESCE(cs_uri_stem, x_edge_location, c_ip) as label,
+            SUM(visits) as visits,
+            APPROX_DISTINCT(c_ip) as unique_visitors,
+            APPROX_DISTINCT(date) as days_tracked,
+            SUM(IF(is_yesterday, visits, 0)) as visits_yesterday,
+            APPROX_DISTINCT(IF(is_yesterday, c_ip)) as unique_yesterday
+        FROM flagged
+        GROUP BY GROUPING SETS ((cs_uri_stem), (x_edge_location), (c_ip), ())
+    ),
+    ranked AS (
+        SELECT 
+            *,
+            ROW_NUMBER() OVER (PARTITION BY grouping_set ORDER BY visits DESC) as row_num
+        FROM grouped
+    )
+    SELECT 
+        CASE grouping_set
+            WHEN 3 THEN 'top_pages'
+            WHEN 5 THEN 'geo_distribution'
+            WHEN 6 THEN 'top_visitors'
+            ELSE 'summary'
+        END as section,
+        label,
+        COALESCE(visits, 0) as value1,
+        unique_visitors as value2,
+        days_tracked as value3,
+        COALESCE(visits_yesterday, 0) as value4,
+        unique_yesterday as value5
+    FROM ranked
+    WHERE grouping_set = 7
+        OR (grouping_set = 3 AND row_num <= 5)
+        OR (grouping_set IN (5, 6) AND row_num <= 10)
+    ORDER BY section, value1 DESC
+"""
 
 def lambda_handler(event, context):
-    """Execute analytics queries and send email report."""
-    today = datetime.now().strftime('%Y-%m-%d')
-    yesterday = (datetime.now() - timedelta(days=1)).strftime('%Y-%m-%d')
-    
-    ip_filter = build_ip_filter()
-    
-    results = {
-        'overview': execute_query(get_overview_query(ip_filter)),
-        'yesterday': execute_query(get_yesterday_query(ip_filter, yesterday)),
-        'top_pages': execute_query(get_top_pages_query(ip_filter)),
-        'geo_distribution': execute_query(get_geo_query(ip_filter)),
-        'top_visitors': execute_query(get_top_visitors_query(ip_filter))
-    }
+    """Execute analytics query and send email report."""
+    # Read the clock once so today/yesterday can't straddle midnight
+    now = datetime.now(timezone.utc)
+    today = now.strftime('%Y-%m-%d')
+    yesterday = (now - _ONE_DAY).strftime('%Y-%m-%d')
+    # Logs can still be arriving for yesterday, so the last complete day is the one before
+    complete_day = (now - 2 * _ONE_DAY).strftime('%Y-%m-%d')
     
-    email_body = format_email_report(yesterday, results)
+    if DAILY_TABLE:
+        roll_up_complete_days(complete_day)
+    
+    rows = execute_query(
+        COMBINED_QUERY,
+        parameters=build_execution_parameters(today, yesterday, complete_day),
+        reuse_results=True
+    )
+    results = split_sections(rows)
+    
+    email_body = format_email_report(now, yesterday, results)
     
     sns_client.publish(
         TopicArn=SNS_TOPIC_ARN,
@@ -52,82 +220,99 @@ def lambda_handler(event, context):
     return {'statusCode': 200, 'body': 'Analytics report sent successfully'}
 
 
-def build_ip_filter():
-    """Build SQL IN clause for filtered IPs."""
-    return "(" + ", ".join([f"'{ip.strip()}'" for ip in FILTERED_IPS]) + ")"
+def roll_up_complete_days(complete_day):
+    """Roll each complete day after the last one in DAILY_TABLE into it, oldest first."""
+    rows = list(execute_query(LAST_ROLLED_UP_DAY_QUERY))
+    if not rows or not rows[0][0]:
+        raise RuntimeError(f"{DAILY_TABLE} is empty; backfill it before enabling DAILY_TABLE")
+    
+    day = datetime.strptime(rows[0][0], '%Y-%m-%d') + _ONE_DAY
+    last_day = datetime.strptime(complete_day, '%Y-%m-%d')
+    while day <= last_day:
+        run_query(
+            DAILY_ROLLUP_QUERY,
+            parameters=build_rollup_parameters(day.strftime('%Y-%m-%d')),
+            timeout=ROLLUP_TIMEOUT_SECONDS,
+            # Stopping a MERGE mid-write gains nothing; a retry redoes the day
+            stop_on_timeout=False
+        )
+        day += _ONE_DAY
 
 
-def get_overview_query(ip_filter):
-    """Return query for all-time overview statistics."""
-    return f"""
-        SELECT 
-            COUNT(*) as total_visits,
-            COUNT(DISTINCT c_ip) as unique_visitors,
-            COUNT(DISTINCT date) as days_tracked
-        FROM {TABLE}
-        WHERE c_ip NOT IN {ip_filter}
-    """
+def build_partition_parameters(day):
+    """Return SQL literals for a day's year/month/day partition values."""
+    year, month, day_of_month = day.split('-')
+    return [f"'{year}'", f"'{month}'", f"'{day_of_month}'"]
 
 
-def get_yesterday_query(ip_filter, yesterday):
-    """Return query for yesterday's traffic statistics."""
-    return f"""
-        SELECT 
-            COUNT(*) as visits_yesterday,
-            COUNT(DISTINCT c_ip) as unique_yesterday
-        FROM {TABLE}
-        WHERE date = DATE '{yesterday}'
-            AND c_ip NOT IN {ip_filter}
-    """
+def build_rollup_parameters(day):
+    """Return Athena execution parameters for the daily rollup placeholders."""
+    return [*build_partition_parameters(day), f"'{day}'", f"'{day}'"]
 
 
-def get_top_pages_query(ip_filter):
-    """Return query for most visited pages."""
-    return f"""
-        SELECT cs_uri_stem, COUNT(*) as visits
-        FROM {TABLE}
-        WHERE c_ip NOT IN {ip_filter}
-        GROUP BY cs_uri_stem
-        ORDER BY visits DESC
-        LIMIT 5
-    """
-
-
-def get_geo_query(ip_filter):
-    """Return query for geographic distribution."""
-    return f"""
-        SELECT x_edge_location, COUNT(*) as requests
-        FROM {TABLE}
-        WHERE c_ip NOT IN {ip_filter}
-        GROUP BY x_edge_location
-        ORDER BY requests DESC
-        LIMIT 10
+def build_execution_parameters(today, yesterday, complete_day):
+    """Return Athena execution parameters for the combined query placeholders.
+    
+    Values are SQL literals, in placeholder order: the DAILY_TABLE cutoff and
+    recent raw-log filter (if DAILY_TABLE is set), filtered IPs, then
+    yesterday's date.
     """
+    parameters = []
+    if DAILY_TABLE:
+        parameters.append(f"'{complete_day}'")
+        parameters += build_partition_parameters(yesterday)
+        parameters += build_partition_parameters(today)
+        parameters.append(f"'{complete_day}'")
+    return [*parameters, *IP_PARAMETERS, f"'{yesterday}'"]
+
+
+def split_sections(rows):
+    """Group combined query rows by their section column."""
+    sections = {
+        'summary': [],
+        'top_pages': [],
+        'geo_distribution': [],
+        'top_visitors': []
+    }
+    for row in rows:
+        sections[row[0]].append(row)
+    return sections
 
 
-def get_top_visitors_query(ip_filter):
-    """Return query for top visitor IPs."""
-    return f"""
-        SELECT c_ip, COUNT(*) as visits
-        FROM {TABLE}
-        WHERE c_ip NOT IN {ip_filter}
-        GROUP BY c_ip
-        ORDER BY visits DESC
-        LIMIT 10
+def run_query(query, parameters=None, reuse_results=False,
+              timeout=QUERY_TIMEOUT_SECONDS, stop_on_timeout=True):
+    """Start an Athena query and wait for it to finish.
+    
+    parameters are bound to the query's ? placeholders. With reuse_results,
+    Athena may serve a cached result up to a day old instead of rescanning
+    the logs. Returns the final QueryExecution description, or raises
+    AthenaQueryError if the query didn't succeed within timeout seconds
+    (stopping it first if stop_on_timeout).
     """
-
-
-def execute_query(query):
-    """Execute Athena query and return results."""
-    response = athena_client.start_query_execution(
-        QueryString=query,
-        QueryExecutionContext={'Database': DATABASE},
-        ResultConfiguration={'OutputLocation': OUTPUT_LOCATION}
-    )
+    request = {
+        'QueryString': query,
+        'QueryExecutionContext': {'Database': DATABASE},
+        'ResultConfiguration': {'OutputLocation': OUTPUT_LOCATION},
+        'ResultReuseConfiguration': {
+            'ResultReuseByAgeConfiguration': {
+                'Enabled': reuse_results,
+                'MaxAgeInMinutes': RESULT_REUSE_MAX_AGE_MINUTES
+            }
+        }
+    }
+    if parameters:
+        request['ExecutionParameters'] = parameters
+    
+    response = athena_client.start_query_execution(**request)
     
     query_execution_id = response['QueryExecutionId']
     
-    for i in range(30):
+    # Poll with exponential backoff so fast queries return quickly and
+    # slow ones don't burn GetQueryExecution calls
+    delay = POLL_INITIAL_DELAY
+    deadline = time.monotonic() + timeout
+    
+    while time.monotonic() < deadline:
         status_response = athena_client.get_query_execution(
             QueryExecutionId=query_execution_id
         )
@@ -135,44 +320,80 @@ def execute_query(query):
         
         if status in ['SUCCEEDED', 'FAILED', 'CANCELLED']:
             break
-        time.sleep(1)
+        time.sleep(delay)
+        delay = min(delay * 1.5, POLL_MAX_DELAY)
+    
+    query_execution = status_response['QueryExecution']
+    
+    # Log scan size and runtime so cost regressions show up in CloudWatch
+    statistics = query_execution.get('Statistics', {})
+    print(
+        f"Athena query {query_execution_id} {status}: "
+        f"{statistics.get('DataScannedInBytes', 0)} bytes scanned, "
+        f"{statistics.get('TotalExecutionTimeInMillis', 0)} ms"
+    )
+    
+    if status != 'SUCCEEDED':
+        if status not in ['FAILED', 'CANCELLED']:
+            reason = f"timed out after {timeout}s"
+            if stop_on_timeout:
+                # Still queued or running; don't leave it billing
+                athena_client.stop_query_execution(QueryExecutionId=query_execution_id)
+            else:
+                reason += ", left running"
+        else:
+            reason = query_execution['Status'].get('StateChangeReason', 'no reason given')
+        error_message = query_execution['Status'].get('AthenaError', {}).get('ErrorMessage')
+        if error_message and error_message != reason:
+            reason = f"{reason} ({error_message})"
+        raise AthenaQueryError(f"Athena query {query_execution_id} {status}: {reason}")
+    
+    return query_execution
+
+
+def execute_query(query, parameters=None, reuse_results=False):
+    """Execute Athena query and yield its data rows."""
+    query_execution = run_query(query, parameters, reuse_results)
     
-    if status == 'SUCCEEDED':
-        results = athena_client.get_query_results(QueryExecutionId=query_execution_id)
-        return results['ResultSet']['Rows']
+    # Read the CSV Athena already wrote instead of the nested GetQueryResults JSON
+    output_location = query_execution['ResultConfiguration']['OutputLocation']
+    bucket, key = output_location[len('s3://'):].split('/', 1)
+    body = s3_client.get_object(Bucket=bucket, Key=key)['Body']
     
-    return []
+    reader = csv.reader(io.TextIOWrapper(body, encoding='utf-8'))
+    next(reader, None)  # header row
+    yield from reader
 
 
-def format_email_report(yesterday, results):
+def format_email_report(now, yesterday, results):
     """Format analytics data into email report."""
     sections = []
     
-    sections.append(f"Website Analytics Report")
-    sections.append(f"Generated: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')} UTC")
-    sections.append("\n" + "=" * 50)
+    sections.append("Website Analytics Report")
+    sections.append(f"Generated: {now.strftime('%Y-%m-%d %H:%M:%S')} UTC")
+    sections.append(SECTION_BREAK)
     sections.append("ALL-TIME OVERVIEW")
-    sections.append("=" * 50)
-    sections.append(format_overview(results['overview']))
+    sections.append(SEPARATOR)
+    sections.append(format_overview(results['summary']))
     
-    sections.append("\n" + "=" * 50)
+    sections.append(SECTION_BREAK)
     sections.append(f"YESTERDAY ({yesterday})")
-    sections.append("=" * 50)
-    sections.append(format_yesterday(results['yesterday']))
+    sections.append(SEPARATOR)
+    sections.append(format_yesterday(results['summary']))
     
-    sections.append("\n" + "=" * 50)
+    sections.append(SECTION_BREAK)
     sections.append("TOP PAGES (All Time)")
-    sections.append("=" * 50)
+    sections.append(SEPARATOR)
     sections.append(format_top_pages(results['top_pages']))
     
-    sections.append("\n" + "=" * 50)
+    sections.append(SECTION_BREAK)
     sections.append("GEOGRAPHIC DISTRIBUTION")
-    sections.append("=" * 50)
+    sections.append(SEPARATOR)
     sections.append(format_geo_distribution(results['geo_distribution']))
     
-    sections.append("\n" + "=" * 50)
+    sections.append(SECTION_BREAK)
     sections.append("TOP VISITORS")
-    sections.append("=" * 50)
+    sections.append(SEPARATOR)
     sections.append(format_top_visitors(results['top_visitors']))
     
     sections.append(f"\nFiltered IPs: {len(FILTERED_IPS)} IP(s) excluded from stats")
@@ -182,54 +403,45 @@ def format_email_report(yesterday, results):
 
 def format_overview(data):
     """Format overview statistics."""
-    if len(data) > 1:
-        total = data[1]['Data'][0]['VarCharValue']
-        unique = data[1]['Data'][1]['VarCharValue']
-        days = data[1]['Data'][2]['VarCharValue']
+    if data:
+        _, _, total, unique, days, _, _ = data[0]
         return f"Total Visits: {total}\nUnique Visitors: {unique}\nDays Tracked: {days}"
     return "No traffic data available."
 
 
 def format_yesterday(data):
     """Format yesterday's statistics."""
-    if len(data) > 1:
-        visits = data[1]['Data'][0]['VarCharValue']
-        unique = data[1]['Data'][1]['VarCharValue']
+    if data:
+        _, _, _, _, _, visits, unique = data[0]
         return f"Visits: {visits}\nUnique Visitors: {unique}"
     return "No traffic yesterday."
 
 
 def format_top_pages(data):
     """Format top pages list."""
-    if len(data) > 1:
+    if data:
         lines = []
-        for row in data[1:]:
-            uri = row['Data'][0].get('VarCharValue', 'N/A')
-            visits = row['Data'][1].get('VarCharValue', '0')
-            lines.append(f"{uri}: {visits} visits")
+        for _, uri, visits, *_ in data:
+            lines.append(f"{uri or 'N/A'}: {visits} visits")
         return "\n".join(lines)
     return "No page data."
 
 
 def format_geo_distribution(data):
     """Format geographic distribution list."""
-    if len(data) > 1:
+    if data:
         lines = []
-        for row in data[1:]:
-            location = row['Data'][0].get('VarCharValue', 'N/A')
-            requests = row['Data'][1].get('VarCharValue', '0')
-            lines.append(f"{location}: {requests} requests")
+        for _, location, requests, *_ in data:
+            lines.append(f"{location or 'N/A'}: {requests} requests")
         return "\n".join(lines)
     return "No geographic data."
 
 
 def format_top_visitors(data):
     """Format top visitors list."""
-    if len(data) > 1:
+    if data:
         lines = []
-        for row in data[1:]:
-            ip = row['Data'][0].get('VarCharValue', 'N/A')
-            visits = row['Data'][1].get('VarCharValue', '0')
-            lines.append(f"{ip}: {visits} visits")
+        for _, ip, visits, *_ in data:
+            lines.append(f"{ip or 'N/A'}: {visits} visits")
         return "\n".join(lines)
     return "No visitor data."
\ No newline at end of file
@@ -1,58 +1,74 @@
-import json
 import os
-import boto3
 from botocore.exceptions import ClientError
 
-dynamodb = boto3.resource('dynamodb')
-table = dynamodb.Table(os.environ.get('TABLE_NAME', 'cloud-resume-visitor-counter'))
+TABLE_NAME = os.environ.get('TABLE_NAME', 'cloud-resume-visitor-counter')
 
-def get_cors_headers():
-    """Return CORS headers for API responses."""
-    return {
-        'Access-Control-Allow-Origin': '*',
-        'Access-Control-Allow-Headers': 'Content-Type',
-        'Access-Control-Allow-Methods': 'POST, OPTIONS'
-    }
+CORS_HEADERS = {
+    'Access-Control-Allow-Origin': '*',
+    'Access-Control-Allow-Headers': 'Content-Type',
+    'Access-Control-Allow-Methods': 'POST, OPTIONS'
+}
+
+OPTIONS_RESPONSE = {
+    'statusCode': 200,
+    'headers': CORS_HEADERS,
+    'body': ''
+}
+
+_dynamodb = None
+
+def _get_dynamodb():
+    """Create the DynamoDB client on first use so preflights skip boto3 setup."""
+    global _dynamodb
+    if _dynamodb is None:
+        import boto3
+        from botocore.config import Config
+
+        # Low-level client skips the resource layer's marshaling; keep-alive
+        # lets warm invocations reuse the HTTPS connection
+        _dynamodb = boto3.client(
+            'dynamodb',
+            config=Config(tcp_keepalive=True, max_pool_connections=1, retries={'mode': 'standard'})
+        )
+    return _dynamodb
 
 def lambda_handler(event, context):
     # Handle OPTIONS preflight request
     if event.get('requestContext', {}).get('http', {}).get('method') == 'OPTIONS':
-        return {
-            'statusCode': 200,
-            'headers': get_cors_headers(),
-            'body': ''
-        }
+        return OPTIONS_RESPONSE
 
     # Handle POST request - increment counter
     try:
-        response = table.update_item(
-            Key={'id': 'visitor-count'},
+        response = _get_dynamodb().update_item(
+            TableName=TABLE_NAME,
+            Key={'id': {'S': 'visitor-count'}},
             UpdateExpression='SET #count = if_not_exists(#count, :start) + :inc',
             ExpressionAttributeNames={'#count': 'count'},
-            ExpressionAttributeValues={':start': 0, ':inc': 1},
+            ExpressionAttributeValues={':start': {'N': '0'}, ':inc': {'N': '1'}},
             ReturnValues='UPDATED_NEW'
         )
 
-        count = int(response['Attributes']['count'])
+        count = int(response['Attributes']['count']['N'])
 
         return {
             'statusCode': 200,
-            'headers': get_cors_headers(),
-            'body': json.dumps({'count': count})
+            'headers': CORS_HEADERS,
+            # count is always an int, so formatting the JSON directly is safe
+            'body': f'{{"count": {count}}}'
         }
 
     except ClientError as e:
         print(f"DynamoDB error: {e.response['Error']['Code']} - {e.response['Error']['Message']}")
         return {
             'statusCode': 500,
-            'headers': get_cors_headers(),
-            'body': json.dumps({'error': 'Failed to update visitor count'})
+            'headers': CORS_HEADERS,
+            'body': '{"error": "Failed to update visitor count"}'
         }
 
     except Exception as e:
         print(f"Unexpected error: {str(e)}")
         return {
             'statusCode': 500,
-            'headers': get_cors_headers(),
-            'body': json.dumps({'error': 'Internal server error'})
+            'headers': CORS_HEADERS,
+            'body': '{"error": "Internal server error"}'
         }
\ No newline at end of file